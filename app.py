@@ -1,23 +1,39 @@
 import os
 import json
 import re
+import string
+import textwrap
 import joblib
 import pickle
 import numpy as np
-import pandas as pd
 import urllib.parse
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response
+import time
+import queue
+import threading
+import functools
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import PyMongoError
 import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 
 # Import MongoDB helpers
-from db import (create_user, verify_user, is_admin, save_detection, get_user_detections, 
+from db import (create_user, verify_user, is_admin, save_detection, flush_detections, get_user_detections, 
                 get_all_detections, save_feedback, save_contact, get_all_contacts, 
-                get_all_feedback, get_analytics_data)
+                get_all_feedback, get_analytics_data, LazyDaemonThread)
 
 # --- Config ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -30,19 +46,45 @@ EMAIL_UNSAFE_PATH = os.path.join(MODELS_DIR, "email_unsafe.json")
 SECRET_KEY = os.environ.get("FLASK_SECRET", "super-secret-key-change-me")
 DEBUG = True
 
+# How long the URL batcher waits for concurrent requests before scoring
+URL_BATCH_WINDOW_MS = float(os.environ.get("URL_BATCH_WINDOW_MS", "2"))
+URL_BATCH_MAX_ROWS = 256
+URL_CACHE_SIZE = 100_000
+
+try:
+    import orjson
+
+    def load_json_file(path):
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+except ImportError:
+    def load_json_file(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
 # --- Flask app ---
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 app.config["SESSION_PERMANENT"] = False
 
+# Optional server-side sessions: with SESSION_REDIS_URL set, the cookie only
+# carries a signed session id and session data lives in Redis
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL")
+if SESSION_REDIS_URL:
+    import redis
+    from flask_session import Session
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.Redis.from_url(SESSION_REDIS_URL)
+    app.config["SESSION_USE_SIGNER"] = True
+    Session(app)
+
 # Load safe URLs
 file_path = os.path.join(MODELS_DIR, "safe_urls.json")
 SAFE_URLS = []
 
 try:
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        SAFE_URLS = data.get("trusted_domains", [])
+    data = load_json_file(file_path)
+    SAFE_URLS = data.get("trusted_domains", [])
 except FileNotFoundError:
     print(f"Error: The file was not found at {file_path}")
 except json.JSONDecodeError:
@@ -57,48 +99,77 @@ word_vectorizer = char_vectorizer = scaler = logreg = svm_calibrated = stacker =
 best_threshold = None
 email_config = {}
 url_model = None
+url_model_needs_frame = True
 url_qhat = None
 url_threshold = None
 phishing_conformal_artifacts = None
 
 EMAIL_UNSAFE_DATA = {}
-EMAIL_UNSAFE_PHRASES = set()
+EMAIL_UNSAFE_PHRASES = ()
+EMAIL_UNSAFE_MATCHER = None
+
+# Serializes /reload_models; the generation counts completed reloads
+_models_lock = threading.Lock()
+_models_generation = 0
+
+def build_phrase_matcher(phrases):
+    """Return a function mapping a lowercased text to the set of phrases it contains"""
+    if ahocorasick is not None:
+        # Aho-Corasick automaton: every phrase is matched in one pass over the text
+        automaton = ahocorasick.Automaton()
+        for p in phrases:
+            automaton.add_word(p, p)
+        automaton.make_automaton()
+        return lambda lower: {p for _, p in automaton.iter(lower)}
+
+    # Without pyahocorasick, one alternation regex rejects clean texts in a single
+    # scan; the per-phrase containment check only runs when something matched
+    any_unsafe = re.compile("|".join(map(re.escape, phrases)))
+
+    def match(lower):
+        if not any_unsafe.search(lower):
+            return set()
+        return {p for p in phrases if p in lower}
+    return match
 
 def load_email_unsafe_keywords():
-    global EMAIL_UNSAFE_DATA, EMAIL_UNSAFE_PHRASES
+    global EMAIL_UNSAFE_DATA, EMAIL_UNSAFE_PHRASES, EMAIL_UNSAFE_MATCHER
     try:
-        with open(EMAIL_UNSAFE_PATH, "r", encoding="utf-8") as f:
-            EMAIL_UNSAFE_DATA = json.load(f)
+        data = load_json_file(EMAIL_UNSAFE_PATH)
         phrases = set()
-        pk = EMAIL_UNSAFE_DATA.get("phishing_keywords", {})
+        pk = data.get("phishing_keywords", {})
         for cat, lst in pk.items():
             for p in lst:
                 if isinstance(p, str) and p.strip():
                     phrases.add(p.strip().lower())
-        other = EMAIL_UNSAFE_DATA.get("other_red_flags", [])
+        other = data.get("other_red_flags", [])
         for p in other:
             if isinstance(p, str) and p.strip():
                 phrases.add(p.strip().lower())
-        EMAIL_UNSAFE_PHRASES = phrases
+        # Longest first, so the alternation regex prefers the most specific phrase
+        ordered = tuple(sorted(phrases, key=len, reverse=True))
+        matcher = build_phrase_matcher(ordered) if phrases else None
     except Exception:
-        EMAIL_UNSAFE_DATA = {}
-        EMAIL_UNSAFE_PHRASES = set()
+        data, ordered, matcher = {}, (), None
+    # Built in locals and swapped in together, so requests never see a half-built matcher
+    EMAIL_UNSAFE_DATA, EMAIL_UNSAFE_PHRASES, EMAIL_UNSAFE_MATCHER = data, ordered, matcher
 
 def load_models():
     global word_vectorizer, char_vectorizer, scaler, logreg, svm_calibrated, stacker, best_threshold
     global email_config, url_model, url_qhat, url_threshold, phishing_conformal_artifacts
+    global url_model_needs_frame
 
     try:
         saved_cmaf_path = SAVED_CMAF_DIR
-        word_vectorizer = joblib.load(os.path.join(saved_cmaf_path, "word_vectorizer.pkl"))
-        char_vectorizer = joblib.load(os.path.join(saved_cmaf_path, "char_vectorizer.pkl"))
-        scaler = joblib.load(os.path.join(saved_cmaf_path, "scaler.pkl"))
-        logreg = joblib.load(os.path.join(saved_cmaf_path, "logreg.pkl"))
-        svm_calibrated = joblib.load(os.path.join(saved_cmaf_path, "svm_calibrated.pkl"))
-        stacker = joblib.load(os.path.join(saved_cmaf_path, "stacker.pkl"))
+        # Memory-map model arrays read-only so preforked workers share the pages
+        word_vectorizer = joblib.load(os.path.join(saved_cmaf_path, "word_vectorizer.pkl"), mmap_mode="r")
+        char_vectorizer = joblib.load(os.path.join(saved_cmaf_path, "char_vectorizer.pkl"), mmap_mode="r")
+        scaler = joblib.load(os.path.join(saved_cmaf_path, "scaler.pkl"), mmap_mode="r")
+        logreg = joblib.load(os.path.join(saved_cmaf_path, "logreg.pkl"), mmap_mode="r")
+        svm_calibrated = joblib.load(os.path.join(saved_cmaf_path, "svm_calibrated.pkl"), mmap_mode="r")
+        stacker = joblib.load(os.path.join(saved_cmaf_path, "stacker.pkl"), mmap_mode="r")
         best_threshold = joblib.load(os.path.join(saved_cmaf_path, "best_threshold.pkl"))
-        with open(os.path.join(saved_cmaf_path, "config.json"), "r", encoding="utf-8") as f:
-            email_config = json.load(f)
+        email_config = load_json_file(os.path.join(saved_cmaf_path, "config.json"))
     except Exception:
         pass
 
@@ -106,10 +177,9 @@ def load_models():
         if os.path.isdir(HYBRID_MODELS_DIR):
             try:
                 url_model = pickle.load(open(os.path.join(HYBRID_MODELS_DIR, "url_model.pkl"), "rb"))
-                with open(os.path.join(HYBRID_MODELS_DIR, "url_params.json"), "r", encoding="utf-8") as f:
-                    url_params = json.load(f)
-                    url_qhat = url_params.get("qhat")
-                    url_threshold = url_params.get("best_threshold")
+                url_params = load_json_file(os.path.join(HYBRID_MODELS_DIR, "url_params.json"))
+                url_qhat = url_params.get("qhat")
+                url_threshold = url_params.get("best_threshold")
             except Exception:
                 pass
     except Exception:
@@ -117,75 +187,160 @@ def load_models():
 
     try:
         if os.path.exists(PHISHING_CONFORMAL_PKL):
-            phishing_conformal_artifacts = joblib.load(PHISHING_CONFORMAL_PKL)
+            phishing_conformal_artifacts = joblib.load(PHISHING_CONFORMAL_PKL, mmap_mode="r")
             url_model = url_model or phishing_conformal_artifacts.get("model")
             url_qhat = url_qhat or phishing_conformal_artifacts.get("qhat")
             url_threshold = url_threshold or phishing_conformal_artifacts.get("best_threshold")
     except Exception:
         pass
 
+    # Models fitted on a DataFrame select columns by name; others take a plain array
+    url_model_needs_frame = url_model is not None and hasattr(url_model, "feature_names_in_")
+
     if not email_config:
         email_config = {"urgent_words": ["urgent", "verify", "password", "bank", "immediately", "action"]}
 
+def reload_all_models():
+    """Reload models and keywords; returns False if a concurrent reload already did it"""
+    global _models_generation
+    seen = _models_generation
+    with _models_lock:
+        if _models_generation != seen:
+            return False
+        load_models()
+        load_email_unsafe_keywords()
+        url_prediction_cache.clear()
+        _models_generation += 1
+    return True
+
 urgent_words = set(email_config.get("urgent_words", []))
 
-def extract_email_meta_features(texts):
-    """Extract meta features from email text with proper calculations"""
+_URL_COUNT_RE = re.compile(r"http[s]?://|www\.")
+
+@dataclass
+class EmailView:
+    """Email text with its lowercased and UTF-8 byte forms, each computed on first use"""
+    text: str
+
+    # Lazy, so paths that never read a form (the trusted-link early return in
+    # hybrid_predict, the non-Numba counter for utf8) don't pay for it
+    @functools.cached_property
+    def lower(self) -> str:
+        return self.text.lower()
+
+    @functools.cached_property
+    def utf8(self) -> np.ndarray:
+        return np.frombuffer(self.text.encode("utf-8", "ignore"), dtype=np.uint8)
+
+def make_email_view(text):
+    return EmailView(text or "")
+
+if njit is not None:
+    @njit(cache=True, fastmath=True, boundscheck=False)
+    def _count_chars(b):
+        """Count ASCII digits, uppercase letters and '!' in one pass over UTF-8 bytes"""
+        nd = nu = ne = 0
+        for i in range(b.shape[0]):
+            # Branchless range tests: (c - lo) | (hi - c) is negative iff c is outside
+            # [lo, hi], so the sign bit gives the membership without a jump and
+            # LLVM can vectorize the loop body
+            c = np.int32(b[i])
+            nd += 1 - ((((c - 48) | (57 - c)) >> 31) & 1)
+            nu += 1 - ((((c - 65) | (90 - c)) >> 31) & 1)
+            ne += 1 - ((((c - 33) | (33 - c)) >> 31) & 1)
+        return nd, nu, ne
+
+    # Warm the JIT at import so the first request doesn't pay for compilation; use a
+    # read-only frombuffer array like make_email_view, which Numba types separately
+    _count_chars(np.frombuffer(b"a", dtype=np.uint8))
+
+    def count_ascii_chars(view):
+        return _count_chars(view.utf8)
+else:
+    # Without Numba, count by deleting characters with str.translate (a C-level scan)
+    _DIGIT_TBL = str.maketrans("", "", string.digits)
+    _UPPER_TBL = str.maketrans("", "", string.ascii_uppercase)
+
+    def count_ascii_chars(view):
+        t = view.text
+        n = len(t)
+        return n - len(t.translate(_DIGIT_TBL)), n - len(t.translate(_UPPER_TBL)), t.count("!")
+
+def extract_email_meta_features(views, matched=None):
+    """Extract meta features from email views with proper calculations.
+
+    matched optionally holds the unsafe phrases already found in each view,
+    so callers that ran the phrase matcher don't scan the text again.
+    """
     features = []
-    for t in texts:
-        length = len(t)
-        num_digits = sum(ch.isdigit() for ch in t)
+    for i, v in enumerate(views):
+        length = len(v.text)
+        num_digits, num_upper, num_exclam = count_ascii_chars(v)
         digit_ratio = num_digits / max(1, length)
-        num_upper = sum(ch.isupper() for ch in t)
         upper_ratio = num_upper / max(1, length)
-        num_exclam = t.count("!")
-        num_urls = len(re.findall(r"http[s]?://|www\.", t))
-        num_urgent = sum(1 for phrase in EMAIL_UNSAFE_PHRASES if phrase in t.lower())
+        num_urls = len(_URL_COUNT_RE.findall(v.text))
+        num_urgent = len(matched[i] if matched is not None else match_unsafe_phrases(v.lower))
         features.append([length, digit_ratio, upper_ratio, num_exclam, num_urls, num_urgent])
-    return np.array(features, dtype=float)
+    return np.array(features, dtype=float).reshape(-1, 6)
+
+# Explanation templates, built once at import and filled per request
+_EMAIL_PHISH_META_RULES = (
+    (lambda m: m.get("num_urgent_terms", 0) > 0,
+     "⚠️ Urgent Language: Contains {num_urgent_terms} urgent/suspicious terms that create false urgency."),
+    (lambda m: m.get("upper_ratio", 0) > 0.1,
+     "📢 Excessive Capitalization: {upper_pct:.1f}% uppercase text suggests aggressive tactics."),
+    (lambda m: m.get("num_exclam", 0) > 2,
+     "❗ Excessive Punctuation: {num_exclam} exclamation marks indicate emotional manipulation."),
+    (lambda m: m.get("num_urls", 0) > 0,
+     "🔗 Suspicious Links: Contains {num_urls} URLs that require verification."),
+)
+_EMAIL_PHISH_HEADER = "🚨 High Risk Detected: This email exhibits multiple characteristics commonly found in phishing attempts."
+_EMAIL_PHISH_FOOTER = "🛡️ Recommendation: Do not click any links, verify sender through alternative means, and report as spam."
+_EMAIL_SAFE_EXPLANATIONS = (
+    "✅ Low Risk Assessment: This email appears to be legitimate based on our analysis.",
+    "📊 Analysis: Content patterns match typical legitimate communication.",
+    "💡 Note: Always verify sender identity for sensitive requests, even for legitimate-looking emails.",
+)
+_URL_EXPLANATIONS = {
+    1: (  # Phishing
+        "🚨 Malicious URL Detected: This URL exhibits patterns associated with phishing websites.",
+        "🔍 Domain Analysis: URL structure and domain characteristics suggest potential threat.",
+        "🛡️ Recommendation: Do not visit this URL. It may steal credentials or install malware.",
+    ),
+    -1: (  # Suspicious
+        "⚠️ Suspicious URL: This URL requires caution and further verification.",
+        "🔍 Analysis: Some characteristics are concerning but not definitively malicious.",
+        "💡 Recommendation: Verify the URL source before visiting. Use caution if proceeding.",
+    ),
+}
+_URL_SAFE_EXPLANATIONS = (
+    "✅ Safe URL: This URL appears to be from a trusted domain.",
+    "🔍 Domain Verification: URL matches known safe domain patterns.",
+    "💡 Note: Always ensure you're on the correct website by checking the full URL.",
+)
+_CONFIDENCE_TEMPLATES = (
+    (0.9, "🎯 High Confidence: Our AI model is {:.1f}% confident in this assessment."),
+    (0.7, "📊 Moderate Confidence: Our AI model is {:.1f}% confident in this assessment."),
+)
+_LOW_CONFIDENCE_TEMPLATE = "⚖️ Lower Confidence: Our AI model is {:.1f}% confident. Consider additional verification."
 
 def generate_ai_explanation(mode, result, input_text, meta_features=None):
     """Generate AI-driven explanations for detection results"""
     explanations = []
     
     if mode == "email":
-        # Email-specific explanations
         if result.get("binary_pred") == 1:  # Phishing
-            explanations.append("🚨 High Risk Detected: This email exhibits multiple characteristics commonly found in phishing attempts.")
-            
+            explanations.append(_EMAIL_PHISH_HEADER)
             if meta_features:
-                if meta_features.get("num_urgent_terms", 0) > 0:
-                    explanations.append(f"⚠️ Urgent Language: Contains {meta_features['num_urgent_terms']} urgent/suspicious terms that create false urgency.")
-                
-                if meta_features.get("upper_ratio", 0) > 0.1:
-                    explanations.append(f"📢 Excessive Capitalization: {meta_features['upper_ratio']*100:.1f}% uppercase text suggests aggressive tactics.")
-                
-                if meta_features.get("num_exclam", 0) > 2:
-                    explanations.append(f"❗ Excessive Punctuation: {meta_features['num_exclam']} exclamation marks indicate emotional manipulation.")
-                
-                if meta_features.get("num_urls", 0) > 0:
-                    explanations.append(f"🔗 Suspicious Links: Contains {meta_features['num_urls']} URLs that require verification.")
-            
-            explanations.append("🛡️ Recommendation: Do not click any links, verify sender through alternative means, and report as spam.")
+                m = meta_features
+                explanations.extend(tpl.format(upper_pct=m.get("upper_ratio", 0) * 100, **m)
+                                    for pred, tpl in _EMAIL_PHISH_META_RULES if pred(m))
+            explanations.append(_EMAIL_PHISH_FOOTER)
         else:  # Safe
-            explanations.append("✅ Low Risk Assessment: This email appears to be legitimate based on our analysis.")
-            explanations.append("📊 Analysis: Content patterns match typical legitimate communication.")
-            explanations.append("💡 Note: Always verify sender identity for sensitive requests, even for legitimate-looking emails.")
+            explanations.extend(_EMAIL_SAFE_EXPLANATIONS)
     
     elif mode == "url":
-        # URL-specific explanations
-        if result.get("binary_pred") == 1:  # Phishing
-            explanations.append("🚨 Malicious URL Detected: This URL exhibits patterns associated with phishing websites.")
-            explanations.append("🔍 Domain Analysis: URL structure and domain characteristics suggest potential threat.")
-            explanations.append("🛡️ Recommendation: Do not visit this URL. It may steal credentials or install malware.")
-        elif result.get("binary_pred") == -1:  # Suspicious
-            explanations.append("⚠️ Suspicious URL: This URL requires caution and further verification.")
-            explanations.append("🔍 Analysis: Some characteristics are concerning but not definitively malicious.")
-            explanations.append("💡 Recommendation: Verify the URL source before visiting. Use caution if proceeding.")
-        else:  # Safe
-            explanations.append("✅ Safe URL: This URL appears to be from a trusted domain.")
-            explanations.append("🔍 Domain Verification: URL matches known safe domain patterns.")
-            explanations.append("💡 Note: Always ensure you're on the correct website by checking the full URL.")
+        explanations.extend(_URL_EXPLANATIONS.get(result.get("binary_pred"), _URL_SAFE_EXPLANATIONS))
     
     elif mode == "hybrid":
         # Hybrid analysis explanations
@@ -199,38 +354,36 @@ def generate_ai_explanation(mode, result, input_text, meta_features=None):
             if email_branch.get("binary_pred") == 1:
                 explanations.append("📧 Email Content Risk: Text analysis reveals phishing patterns.")
             
-            if url_branch and any(u.get("binary_pred") == 1 for u in url_branch):
-                malicious_urls = [u for u in url_branch if u.get("binary_pred") == 1]
-                explanations.append(f"🔗 Malicious Links: {len(malicious_urls)} suspicious URLs detected in content.")
+            n_malicious = sum(1 for u in url_branch if u.get("binary_pred") == 1)
+            if n_malicious:
+                explanations.append(f"🔗 Malicious Links: {n_malicious} suspicious URLs detected in content.")
             
             explanations.append("🛡️ Critical Action Required: Delete this email immediately and do not interact with any content.")
         else:  # Safe
             explanations.append("✅ Comprehensive Safety Check: Multi-layer analysis indicates this content is likely safe.")
             
             # Check for safe domains override
-            if url_branch and any(u.get("label") == "Safe URL" for u in url_branch):
-                safe_urls = [u for u in url_branch if u.get("label") == "Safe URL"]
-                explanations.append(f"🔗 Trusted Domains: Contains {len(safe_urls)} links to verified safe domains.")
+            n_safe = sum(1 for u in url_branch if u.get("label") == "Safe URL")
+            if n_safe:
+                explanations.append(f"🔗 Trusted Domains: Contains {n_safe} links to verified safe domains.")
             
             explanations.append("💡 Best Practice: Continue to verify sender identity for any sensitive requests.")
     
     # Add confidence explanation
     confidence = result.get("probability", result.get("confidence", result.get("final_proba", 0)))
-    if confidence > 0.9:
-        explanations.append(f"🎯 High Confidence: Our AI model is {confidence*100:.1f}% confident in this assessment.")
-    elif confidence > 0.7:
-        explanations.append(f"📊 Moderate Confidence: Our AI model is {confidence*100:.1f}% confident in this assessment.")
-    else:
-        explanations.append(f"⚖️ Lower Confidence: Our AI model is {confidence*100:.1f}% confident. Consider additional verification.")
+    tpl = next((t for threshold, t in _CONFIDENCE_TEMPLATES if confidence > threshold), _LOW_CONFIDENCE_TEMPLATE)
+    explanations.append(tpl.format(confidence * 100))
     
     return explanations
 
-def predict_email_with_model(text):
+def predict_email_with_model(view, matched_phrases=None):
     """Enhanced email prediction with proper meta feature calculation"""
-    meta = extract_email_meta_features([text])[0]
+    # One phrase scan feeds both the rule check and the urgent-term count
+    if matched_phrases is None:
+        matched_phrases = check_email_unsafe_by_rules(view)
+    meta = extract_email_meta_features([view], [matched_phrases])[0]
     
     # Basic prediction logic (replace with actual model when available)
-    matched_phrases = check_email_unsafe_by_rules(text)
     if matched_phrases:
         probability = 0.85 + (len(matched_phrases) * 0.05)  # Higher confidence with more matches
         probability = min(probability, 0.98)  # Cap at 98%
@@ -272,21 +425,32 @@ def predict_email_with_model(text):
         }
     }
 
-def check_email_unsafe_by_rules(text):
-    if not EMAIL_UNSAFE_PHRASES:
-        return []
-    lower = text.lower()
-    matched = [p for p in EMAIL_UNSAFE_PHRASES if p in lower]
-    return matched
+def match_unsafe_phrases(lower):
+    """Return the set of unsafe phrases found in an already lowercased text"""
+    matcher = EMAIL_UNSAFE_MATCHER
+    if matcher is None:
+        return set()
+    return matcher(lower)
+
+def check_email_unsafe_by_rules(view):
+    return list(match_unsafe_phrases(view.lower))
 
 # --- URL helpers ---
-def extract_urls(email_text: str):
-    URL_REGEX = re.compile(r"""(?i)\b((?:https?://|www\.)[^\s<>"'\)\]]+)""", re.IGNORECASE)
-    hits = URL_REGEX.findall(email_text or "")
-    normed = [u if u.lower().startswith(("http://", "https://")) else f"http://{u}" for u in hits]
-    return normed
+URL_REGEX = re.compile(r"""(?i)\b((?:https?://|www\.)[^\s<>"'\)\]]+)""")
+
+def extract_urls(view: EmailView):
+    """Yield URLs found in the email, normalized to carry a scheme"""
+    for m in URL_REGEX.finditer(view.text):
+        u = m.group(1)
+        yield u if u[:4].lower() == "http" else f"http://{u}"
+
+# Netloc of a "scheme://host..." URL; anything else goes through urllib
+_NETLOC_RE = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*://([^/?#\[\]]+)")
 
 def parse_domain_and_path(url: str):
+    m = _NETLOC_RE.match(url)
+    if m:
+        return m.group(1).lower(), "", ""
     try:
         parsed = urllib.parse.urlparse(url)
         domain = parsed.netloc or parsed.path
@@ -300,27 +464,26 @@ def normalize_domain_for_check(domain: str):
         d = d[4:]
     return d
 
+# Hash set of trusted domains, normalized the same way as the domains we
+# look up; subdomains are matched by stripping one label at a time
+SAFE_DOMAINS = frozenset(normalize_domain_for_check(s) for s in SAFE_URLS if isinstance(s, str))
+
 def is_known_safe_domain(domain: str):
     d = normalize_domain_for_check(domain)
-    for s in SAFE_URLS:
-        if d == s or d.endswith("." + s):
+    while d:
+        if d in SAFE_DOMAINS:
             return True
+        d = d.partition(".")[2]
     return False
 
-def build_model_ready_url_features(url: str):
-    domain, _, _ = parse_domain_and_path(url)
-    return {"domain": domain, "dummy": 1}
+URL_FEATURE_COLUMNS = ("domain", "dummy")
 
-def predict_url_from_features(feature_row):
-    global url_model
-    if not url_model:
-        return {"label": "Suspicious URL", "binary_pred": -1, "confidence": 0.5}
-    try:
-        df = pd.DataFrame([feature_row])
-        proba = float(url_model.predict_proba(df)[:, 1][0])
-    except Exception:
-        proba = 0.5
+def build_model_ready_url_features(url: str, domain=None):
+    if domain is None:
+        domain, _, _ = parse_domain_and_path(url)
+    return {"domain": domain, "dummy": 1}
 
+def label_url_proba(proba):
     if proba < 0.5:
         label = "Suspicious URL"
         binary_pred = -1
@@ -329,44 +492,188 @@ def predict_url_from_features(feature_row):
         binary_pred = 1
     return {"label": label, "binary_pred": binary_pred, "confidence": proba}
 
+def score_url_rows(feature_rows):
+    values = [[row[c] for c in URL_FEATURE_COLUMNS] for row in feature_rows]
+    if url_model_needs_frame:
+        import pandas as pd  # imported on first use to keep worker startup light
+        X = pd.DataFrame(values, columns=list(URL_FEATURE_COLUMNS))
+    else:
+        X = np.array(values, dtype=object)
+    return [float(p) for p in url_model.predict_proba(X)[:, 1]]
+
+class UrlBatcher:
+    """Coalesce URL scoring jobs from concurrent requests into one predict_proba call"""
+
+    def __init__(self, score_fn, window_s, max_rows):
+        self._score_fn = score_fn
+        self._window_s = window_s
+        self._max_rows = max_rows
+        self._jobs = queue.Queue()
+        self._worker = LazyDaemonThread(self._run, "url-batcher")
+
+    def predict_proba(self, feature_rows):
+        """Block until the rows have been scored as part of a batch"""
+        self._worker.ensure_started()
+        fut = Future()
+        self._jobs.put((feature_rows, fut))
+        return fut.result()
+
+    def _collect(self):
+        jobs = [self._jobs.get()]
+        n_rows = len(jobs[0][0])
+        deadline = time.monotonic() + self._window_s
+        while n_rows < self._max_rows:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            n_rows += len(job[0])
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            try:
+                probas = self._score_fn([r for rows, _ in jobs for r in rows])
+            except Exception as e:
+                if len(jobs) == 1:
+                    jobs[0][1].set_exception(e)
+                    continue
+                # Don't let one bad request fail the others in its batch
+                for rows, fut in jobs:
+                    try:
+                        fut.set_result(self._score_fn(rows))
+                    except Exception as job_err:
+                        fut.set_exception(job_err)
+                continue
+            offset = 0
+            for rows, fut in jobs:
+                fut.set_result(probas[offset:offset + len(rows)])
+                offset += len(rows)
+
+url_batcher = UrlBatcher(score_url_rows, URL_BATCH_WINDOW_MS / 1000.0, URL_BATCH_MAX_ROWS)
+
+def predict_urls_from_features(feature_rows):
+    """Score several URL feature rows through the shared batcher.
+
+    Returns (results, degraded); degraded is True when the results are
+    placeholders because no model was loaded or scoring failed.
+    """
+    global url_model
+    if not url_model:
+        return [{"label": "Suspicious URL", "binary_pred": -1, "confidence": 0.5} for _ in feature_rows], True
+    try:
+        probas = url_batcher.predict_proba(feature_rows)
+    except Exception:
+        return [label_url_proba(0.5) for _ in feature_rows], True
+    return [label_url_proba(p) for p in probas], False
+
+def predict_url_from_features(feature_row):
+    return predict_urls_from_features([feature_row])[0][0]
+
+class LRUCache:
+    """Thread-safe least-recently-used mapping with a fixed capacity"""
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Phishing campaigns reuse links, so verdicts are cached per normalized URL
+url_prediction_cache = LRUCache(URL_CACHE_SIZE)
+
+def canonical_url(url: str):
+    """Lowercase, drop the fragment and strip trailing sentence punctuation"""
+    return url.strip().lower().split("#", 1)[0].rstrip(".,;:!?")
+
+def predict_urls(urls):
+    """Predict a list of URLs, batching all uncached non-trusted ones into one model call"""
+    canon = [canonical_url(u) for u in urls]
+    verdicts = {}
+    pending = []
+    for c in canon:
+        if c in verdicts:
+            continue
+        cached = url_prediction_cache.get(c)
+        if cached is not None:
+            verdicts[c] = cached
+            continue
+        domain, _, _ = parse_domain_and_path(c)
+        if is_known_safe_domain(domain):
+            verdicts[c] = {"label": "Safe URL", "binary_pred": 0, "confidence": 0.98}
+            url_prediction_cache.put(c, verdicts[c])
+        else:
+            verdicts[c] = None
+            pending.append((c, domain))
+
+    if pending:
+        scored, degraded = predict_urls_from_features([build_model_ready_url_features(c, d) for c, d in pending])
+        for (c, _), res in zip(pending, scored):
+            verdicts[c] = res
+            # Fallback verdicts are not cached, so the next request retries the model
+            if not degraded:
+                url_prediction_cache.put(c, res)
+
+    # Copy cached verdicts so callers can annotate results freely
+    return [{**verdicts[c], "url": u} for u, c in zip(urls, canon)]
+
 def predict_url(url: str):
-    domain, _, _ = parse_domain_and_path(url)
-    if is_known_safe_domain(domain):
-        return {"url": url, "label": "Safe URL", "binary_pred": 0, "confidence": 0.98}
-
-    feat = build_model_ready_url_features(url)
-    res = predict_url_from_features(feat)
-    res["url"] = url
-    return res
-
-def predict_urls_in_text(email_text: str):
-    urls = extract_urls(email_text)
-    results = []
-    for u in urls:
-        res = predict_url(u)
-        results.append(res)
-    return results
+    return predict_urls([url])[0]
 
-def hybrid_predict(email_text: str):
-    matched = check_email_unsafe_by_rules(email_text)
-    if matched:
-        meta = extract_email_meta_features([email_text])[0]
-        email_res = {"label": "Phishing Email", "probability": 0.98, "score": 9.6,
-                     "binary_pred": 1,
-                     "meta": {"length": float(meta[0]), "digit_ratio": float(meta[1]),
-                              "upper_ratio": float(meta[2]), "num_exclam": float(meta[3]),
-                              "num_urls": float(meta[4]), "num_urgent_terms": float(meta[5])}}
-    else:
-        email_res = predict_email_with_model(email_text)
+def predict_urls_in_text(view: EmailView):
+    return predict_urls(list(extract_urls(view)))
+
+# Email branch reported when a trusted link settles the verdict before text analysis
+EMAIL_NOT_ANALYZED = {"label": "Not Analyzed", "probability": 0.02, "score": 0.2,
+                      "binary_pred": 0, "meta": {}}
 
-    url_res_list = predict_urls_in_text(email_text)
+# Meta placeholder for hybrid verdicts that don't depend on the meta features
+EMPTY_EMAIL_META = {"length": 0.0, "digit_ratio": 0.0, "upper_ratio": 0.0, "num_exclam": 0.0,
+                    "num_urls": 0.0, "num_urgent_terms": 0.0}
+
+def hybrid_predict(email_text: str):
+    view = make_email_view(email_text)
+    url_res_list = predict_urls_in_text(view)
 
     # --- NEW: if any safe domain is detected, override final verdict ---
+    # The email branch can't change the outcome then, so skip it entirely
     if any(u["label"] == "Safe URL" for u in url_res_list):
         return {"final_label": "Safe Content", "final_proba": 0.98, "final_binary_pred": 0,
-                "email_branch": email_res, "url_branch": url_res_list}
+                "email_branch": dict(EMAIL_NOT_ANALYZED, meta={}), "url_branch": url_res_list}
+
+    matched = check_email_unsafe_by_rules(view)
+    if matched:
+        # The rule match fixes the probability and the hybrid page doesn't show meta
+        # features, so skip the extra full-text scan
+        email_res = {"label": "Phishing Email", "probability": 0.98, "score": 9.6,
+                     "binary_pred": 1, "meta": dict(EMPTY_EMAIL_META)}
+    else:
+        email_res = predict_email_with_model(view, matched)
 
-    url_proba = np.mean([u.get("confidence", 0.5) for u in url_res_list]) if url_res_list else 0.5
+    confs = [u.get("confidence", 0.5) for u in url_res_list]
+    url_proba = sum(confs) / len(confs) if confs else 0.5
     final_proba = (email_res.get("probability", 0.5) + url_proba) / 2.0
     final_binary_pred = 1 if final_proba >= 0.5 else 0
     final_label = "Phishing Content" if final_binary_pred == 1 else "Safe Content"
@@ -375,6 +682,35 @@ def hybrid_predict(email_text: str):
             "final_binary_pred": final_binary_pred, "email_branch": email_res,
             "url_branch": url_res_list}
 
+# --- PDF reports ---
+# How long an export waits for buffered detections to reach the database
+REPORT_FLUSH_TIMEOUT_S = 2.0
+# Only the fields the report prints are fetched from MongoDB
+REPORT_PROJECTION = {"timestamp": 1, "mode": 1, "username": 1, "input_text": 1,
+                     "result.label": 1, "result.probability": 1, "result.confidence": 1,
+                     "result.final_label": 1, "result.final_proba": 1}
+
+REPORT_FONTS = ("Helvetica", "Helvetica-Bold")
+
+@functools.lru_cache(maxsize=None)
+def report_layout():
+    """Page size, details anchor and the title/footer lines, as (font, size, x, y, text)"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfbase import pdfmetrics
+    # Resolve font metrics once per process rather than on a report's first setFont
+    for font in REPORT_FONTS:
+        pdfmetrics.getFont(font)
+    width, height = letter
+    header = (("Helvetica-Bold", 16, 50, height - 50, "Phishing Detection Report"),)
+    footer = (("Helvetica", 8, 50, 50, "Generated by Phishing Detection System"),
+              ("Helvetica", 8, 50, 35, "Developers: PRANAV VP, PRAJWAL CA, NAGASHREE DS, PALLAVI JHA"))
+    return letter, height - 100, header, footer
+
+def draw_static_text(p, lines):
+    for font, size, x, y, text in lines:
+        p.setFont(font, size)
+        p.drawString(x, y, text)
+
 # --- Flask routes ---
 @app.route("/")
 def index():
@@ -439,16 +775,16 @@ def predict():
             flash("Provide email body text for analysis", "danger")
             return redirect(url_for("dashboard"))
         
-        res = predict_email_with_model(text)
+        res = predict_email_with_model(make_email_view(text))
         
         explanations = generate_ai_explanation("email", res, text, res.get("meta"))
         res["explanations"] = explanations
         
         # Save detection to database
-        detection = save_detection(username, mode, text, res)
-        session['last_detection_id'] = str(detection.inserted_id)
+        detection_id = str(save_detection(username, mode, text, res))
+        session['last_detection_id'] = detection_id
         
-        return render_template("result.html", mode="Email", input_text=text, result=res, detection_id=str(detection.inserted_id))
+        return render_template("result.html", mode="Email", input_text=text, result=res, detection_id=detection_id)
 
     elif mode == "url":
         target = url_input or text
@@ -462,10 +798,10 @@ def predict():
         res["explanations"] = explanations
         
         # Save detection to database
-        detection = save_detection(username, mode, target, res, url_input)
-        session['last_detection_id'] = str(detection.inserted_id)
+        detection_id = str(save_detection(username, mode, target, res, url_input))
+        session['last_detection_id'] = detection_id
         
-        return render_template("result.html", mode="URL", input_text=target, result=res, detection_id=str(detection.inserted_id))
+        return render_template("result.html", mode="URL", input_text=target, result=res, detection_id=detection_id)
 
     elif mode == "hybrid":
         if not text:
@@ -478,10 +814,10 @@ def predict():
         res["explanations"] = explanations
         
         # Save detection to database
-        detection = save_detection(username, mode, text, res)
-        session['last_detection_id'] = str(detection.inserted_id)
+        detection_id = str(save_detection(username, mode, text, res))
+        session['last_detection_id'] = detection_id
         
-        return render_template("result.html", mode="Hybrid", input_text=text, result=res, detection_id=str(detection.inserted_id))
+        return render_template("result.html", mode="Hybrid", input_text=text, result=res, detection_id=detection_id)
     else:
         flash("Unknown mode", "danger")
         return redirect(url_for("dashboard"))
@@ -550,33 +886,26 @@ def analytics():
                 'username': username
             })
         
-        # Calculate enhanced metrics
-        total_detections = len(sample_detections)
-        email_detections = len([d for d in sample_detections if d['mode'] == 'email'])
-        url_detections = len([d for d in sample_detections if d['mode'] == 'url'])
-        hybrid_detections = len([d for d in sample_detections if d['mode'] == 'hybrid'])
-        
+        # Calculate enhanced metrics in a single pass
+        mode_counts = Counter()
         phishing_count = 0
-        safe_count = 0
         
         for detection in sample_detections:
+            mode = detection["mode"]
+            mode_counts[mode] += 1
             result = detection.get("result", {})
-            if detection["mode"] == "hybrid":
-                if result.get("final_binary_pred") == 1:
-                    phishing_count += 1
-                else:
-                    safe_count += 1
-            else:
-                if result.get("binary_pred") == 1:
-                    phishing_count += 1
-                else:
-                    safe_count += 1
+            pred_key = "final_binary_pred" if mode == "hybrid" else "binary_pred"
+            if result.get(pred_key) == 1:
+                phishing_count += 1
+        
+        total_detections = len(sample_detections)
+        safe_count = total_detections - phishing_count
         
         analytics_data = {
             'total_detections': total_detections,
-            'email_detections': email_detections,
-            'url_detections': url_detections,
-            'hybrid_detections': hybrid_detections,
+            'email_detections': mode_counts['email'],
+            'url_detections': mode_counts['url'],
+            'hybrid_detections': mode_counts['hybrid'],
             'phishing_count': phishing_count,
             'safe_count': safe_count,
             'detections': sample_detections
@@ -728,29 +1057,41 @@ def export_report(detection_id):
     if not session.get("username"):
         return redirect(url_for("login"))
     
+    if not ObjectId.is_valid(detection_id):
+        flash("Invalid detection ID", "danger")
+        return redirect(url_for("dashboard"))
+    
     # Get detection from database
     from db import detections_collection
+    # Bounded so a stalled background flush can't hold the request thread
+    flush_detections(timeout=REPORT_FLUSH_TIMEOUT_S)
     try:
-        detection = detections_collection.find_one({"_id": ObjectId(detection_id)})
-        if not detection or detection["username"] != session.get("username"):
-            flash("Detection not found", "danger")
-            return redirect(url_for("dashboard"))
-    except:
+        detection = detections_collection.find_one(
+            {"_id": ObjectId(detection_id), "username": session.get("username")},
+            projection=REPORT_PROJECTION)
+    except InvalidId:
         flash("Invalid detection ID", "danger")
         return redirect(url_for("dashboard"))
+    except PyMongoError as e:
+        print(f"Error loading detection {detection_id}: {e}")
+        flash("Could not load detection, please try again", "danger")
+        return redirect(url_for("dashboard"))
+    if not detection:
+        flash("Detection not found", "danger")
+        return redirect(url_for("dashboard"))
     
     # Create PDF report
+    from reportlab.pdfgen import canvas
+    pagesize, details_y, header, footer = report_layout()
     buffer = io.BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
+    p = canvas.Canvas(buffer, pagesize=pagesize)
     
     # Title
-    p.setFont("Helvetica-Bold", 16)
-    p.drawString(50, height - 50, "Phishing Detection Report")
+    draw_static_text(p, header)
     
     # Detection details
     p.setFont("Helvetica", 12)
-    y = height - 100
+    y = details_y
     p.drawString(50, y, f"Date: {detection['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}")
     y -= 20
     p.drawString(50, y, f"Mode: {detection['mode'].title()}")
@@ -765,18 +1106,7 @@ def export_report(detection_id):
     p.setFont("Helvetica", 10)
     
     # Wrap text
-    input_text = detection['input_text']
-    lines = []
-    words = input_text.split()
-    current_line = ""
-    for word in words:
-        if len(current_line + word) < 80:
-            current_line += word + " "
-        else:
-            lines.append(current_line.strip())
-            current_line = word + " "
-    if current_line:
-        lines.append(current_line.strip())
+    lines = textwrap.wrap(detection['input_text'], width=80, break_on_hyphens=False)
     
     for line in lines[:10]:  # Limit to 10 lines
         p.drawString(50, y, line)
@@ -802,26 +1132,21 @@ def export_report(detection_id):
         p.drawString(50, y, f"Confidence: {confidence * 100:.2f}%")
     
     # Footer
-    p.setFont("Helvetica", 8)
-    p.drawString(50, 50, "Generated by Phishing Detection System")
-    p.drawString(50, 35, "Developers: PRANAV VP, PRAJWAL CA, NAGASHREE DS, PALLAVI JHA")
+    draw_static_text(p, footer)
     
     p.showPage()
     p.save()
     
+    # Stream the buffer itself rather than copying the PDF out of it
     buffer.seek(0)
-    response = make_response(buffer.getvalue())
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename=detection_report_{detection_id}.pdf'
-    
-    return response
+    return send_file(buffer, mimetype='application/pdf', as_attachment=True,
+                     download_name=f'detection_report_{detection_id}.pdf')
 
 @app.route("/reload_models")
 def reload_models():
     if not DEBUG:
         return "disabled", 403
-    load_models()
-    load_email_unsafe_keywords()
+    reload_all_models()
     return "reloaded"
 
 load_models()
@@ -1,16 +1,37 @@
 # FOR MONGODB COMPASS INTEGRATION:
-from pymongo import MongoClient
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, PyMongoError
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 import os
+import time
+import atexit
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from bson import ObjectId
+from bson.datetime_ms import DatetimeMS
 
 # MongoDB connection
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME = "phishing_detector"
+# Wire compressors in order of preference; ones whose library is missing are skipped
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "zstd,zlib")
 
 # ✅ Create Mongo client using that URI
-client = MongoClient(MONGO_URI)
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=32,
+    minPoolSize=4,
+    compressors=MONGO_COMPRESSORS,
+    zlibCompressionLevel=3,
+    retryWrites=True,
+    w=1,
+    serverSelectionTimeoutMS=2000,
+    socketTimeoutMS=10000,
+)
 db = client[DB_NAME]
 
 
@@ -20,56 +41,165 @@ detections_collection = db["detections"]
 feedback_collection = db["feedback"]
 contacts_collection = db["contacts"]
 
+# Detections are buffered and written in batches off the request path
+DETECTION_FLUSH_INTERVAL_S = 0.1
+DETECTION_FLUSH_MAX = 500
+# Detections kept in memory while MongoDB is unreachable; the oldest are dropped beyond this
+DETECTION_BUFFER_MAX = 10_000
+
+# Number of detections returned with analytics for the history table and charts
+ANALYTICS_RECENT_LIMIT = 500
+
+# Read-heavy admin/analytics queries are cached per process for a short time
+READ_CACHE_TTL_S = 30
+# Each analytics entry carries up to ANALYTICS_RECENT_LIMIT documents, so keep few
+READ_CACHE_MAX_ENTRIES = 64
+
+_detection_buffer = deque()
+_detection_cond = threading.Condition()
+_flush_lock = threading.Lock()
+_read_cache = {}
+_read_cache_lock = threading.Lock()
+# Contact and feedback inserts run off the request thread; threads start on first submit
+_write_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="db-writer")
+
+class LazyDaemonThread:
+    """Background daemon thread that is started on first use, not at import.
+
+    Under gunicorn --preload the app is imported once in the master and then
+    forked, and threads don't survive a fork, so each worker process has to
+    start its own; ensure_started also restarts the thread if it has died.
+    """
+
+    def __init__(self, target, name):
+        self._target = target
+        self._name = name
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._target, name=self._name, daemon=True)
+                self._thread.start()
+
+def cached_read(key_fn, ttl=READ_CACHE_TTL_S):
+    """Cache a read helper's result under key_fn(*args) for ttl seconds."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            key = key_fn(*args)
+            now = time.monotonic()
+            hit = _read_cache.get(key)
+            if hit is not None and hit[0] > now:
+                return hit[1]
+            value = fn(*args)
+            _store_cached_read(key, now + ttl, value)
+            return value
+        return wrapper
+    return decorator
+
+def _store_cached_read(key, expires, value):
+    """Insert into the read cache, dropping expired entries and then the oldest ones."""
+    with _read_cache_lock:
+        now = time.monotonic()
+        for stale in [k for k, (exp, _) in _read_cache.items() if exp <= now]:
+            del _read_cache[stale]
+        _read_cache.pop(key, None)
+        while len(_read_cache) >= READ_CACHE_MAX_ENTRIES:
+            del _read_cache[next(iter(_read_cache))]
+        _read_cache[key] = (expires, value)
+
+def utc_now():
+    """Current UTC time as a BSON datetime, without building a datetime object."""
+    return DatetimeMS(time.time_ns() // 1_000_000)
+
+def invalidate_cached_reads(*keys):
+    with _read_cache_lock:
+        for key in keys:
+            _read_cache.pop(key, None)
+
+def _analytics_key(username=None):
+    return f"analytics:{username or '_all'}"
+
+def ensure_indexes():
+    """Create the indexes behind the history, admin and analytics queries."""
+    indexes = [
+        (detections_collection, [("username", ASCENDING), ("timestamp", DESCENDING)], {}),
+        (detections_collection, [("timestamp", DESCENDING)], {}),
+        (feedback_collection, [("timestamp", DESCENDING)], {}),
+        (contacts_collection, [("timestamp", DESCENDING)], {}),
+        (users_collection, [("username", ASCENDING)], {"unique": True}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except PyMongoError as e:
+            # e.g. a socket timeout while a large collection is indexed; the server
+            # keeps building, and the app must still start
+            print(f"Could not create index {keys} on {collection.name}: {e}")
+
+# Argon2id for new hashes; werkzeug PBKDF2 hashes are upgraded on next login
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64_000, parallelism=1)
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+def check_password(username, password_hash, password):
+    """Verify a password against its stored hash, upgrading legacy or outdated hashes."""
+    if password_hash.startswith("$argon2"):
+        try:
+            password_hasher.verify(password_hash, password)
+        except (VerificationError, InvalidHash):
+            return False
+        if not password_hasher.check_needs_rehash(password_hash):
+            return True
+    elif not check_password_hash(password_hash, password):
+        return False
+    users_collection.update_one({"username": username},
+                                {"$set": {"password_hash": hash_password(password)}})
+    return True
+
 def create_user(username, password):
     """Insert a new user if username is not taken."""
     if users_collection.find_one({"username": username}):
         return False
-    password_hash = generate_password_hash(password)
     user_data = {
-        "username": username, 
-        "password_hash": password_hash,
-        "created_at": datetime.utcnow(),
-        "is_admin": username == "admin"  # Make admin user automatically
+        "password_hash": hash_password(password),
+        "created_at": utc_now(),
+        "is_admin": False
     }
-    users_collection.insert_one(user_data)
-    
-    if username == "admin":
-        # Ensure admin user has the correct password
-        admin_user = users_collection.find_one({"username": "admin"})
-        if admin_user:
-            # Update admin password to ppnp@123
-            new_password_hash = generate_password_hash("ppnp@123")
-            users_collection.update_one(
-                {"username": "admin"},
-                {"$set": {"password_hash": new_password_hash, "is_admin": True}}
-            )
-    
-    return True
+    # Upsert so a concurrent registration of the same name cannot insert twice
+    result = users_collection.update_one({"username": username},
+                                         {"$setOnInsert": user_data}, upsert=True)
+    return result.upserted_id is not None
 
 def verify_user(username, password):
     """Check if user exists and password matches."""
     user = users_collection.find_one({"username": username})
-    if not user:
-        if username == "admin" and password == "ppnp@123":
-            create_admin_user()
-            user = users_collection.find_one({"username": username})
-    
     if not user:
         return False
-    return check_password_hash(user["password_hash"], password)
-
-def create_admin_user():
-    """Create default admin user with specified credentials"""
-    admin_exists = users_collection.find_one({"username": "admin"})
-    if not admin_exists:
-        password_hash = generate_password_hash("ppnp@123")
-        admin_data = {
-            "username": "admin",
-            "password_hash": password_hash,
-            "created_at": datetime.utcnow(),
-            "is_admin": True
-        }
-        users_collection.insert_one(admin_data)
+    return check_password(username, user["password_hash"], password)
+
+def ensure_admin():
+    """Create the default admin user if it does not exist yet."""
+    # Cheap indexed check first, so restarts don't pay for an Argon2 hash
+    if users_collection.find_one({"username": "admin"}, projection={"_id": 1}):
+        return
+    admin_data = {
+        "password_hash": hash_password("ppnp@123"),
+        "created_at": utc_now(),
+        "is_admin": True
+    }
+    try:
+        result = users_collection.update_one({"username": "admin"},
+                                             {"$setOnInsert": admin_data}, upsert=True)
+    except DuplicateKeyError:
+        # Another worker inserted the admin between our match and insert
+        return
+    if result.upserted_id is not None:
         print("Admin user created successfully")
 
 def is_admin(username):
@@ -77,17 +207,95 @@ def is_admin(username):
     user = users_collection.find_one({"username": username})
     return user and user.get("is_admin", False)
 
+def flush_detections(timeout=None):
+    """Write all buffered detections to the database.
+
+    With a timeout, gives up waiting for a flush already in progress after
+    that many seconds and returns False.
+    """
+    # Held across the insert so a caller flushing before a read-back also waits
+    # for a batch the background thread has already taken off the buffer
+    if not _flush_lock.acquire(timeout=-1 if timeout is None else timeout):
+        return False
+    try:
+        batch = []
+        while _detection_buffer:
+            batch.append(_detection_buffer.popleft())
+        if not batch:
+            return True
+        try:
+            detections_collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Unordered insert: only the reported documents were rejected
+            failed = [batch[err["index"]] for err in e.details.get("writeErrors", [])
+                      if err.get("code") != 11000]
+            _insert_detections_one_by_one(failed)
+        except ConnectionFailure as e:
+            # Database unreachable: keep the batch for the next flush instead of
+            # spending a server selection timeout on every document
+            print(f"Error saving {len(batch)} detections, will retry: {e}")
+            with _detection_cond:
+                _detection_buffer.extendleft(reversed(batch))
+                _trim_detection_buffer()
+            return True
+        except Exception as e:
+            print(f"Error saving detections, ids {', '.join(str(d['_id']) for d in batch)}: {e}")
+        invalidate_cached_reads(_analytics_key(), *{_analytics_key(d["username"]) for d in batch})
+        return True
+    finally:
+        _flush_lock.release()
+
+def _trim_detection_buffer():
+    """Drop the oldest buffered detections beyond DETECTION_BUFFER_MAX; call under _detection_cond."""
+    if len(_detection_buffer) <= DETECTION_BUFFER_MAX:
+        return
+    lost = []
+    while len(_detection_buffer) > DETECTION_BUFFER_MAX:
+        lost.append(str(_detection_buffer.popleft()["_id"]))
+    print(f"Detection buffer full, dropped {len(lost)} detections, ids {', '.join(lost)}")
+
+def _insert_detections_one_by_one(docs):
+    """Retry a failed batch per document so one bad write loses only that document."""
+    lost = []
+    error = None
+    for doc in docs:
+        try:
+            detections_collection.insert_one(doc)
+        except DuplicateKeyError:
+            pass  # written by the batch insert before it failed
+        except Exception as e:
+            lost.append(str(doc["_id"]))
+            error = e
+    if lost:
+        print(f"Error saving {len(lost)} detections, ids {', '.join(lost)}: {error}")
+
+def _flush_detections_loop():
+    while True:
+        with _detection_cond:
+            _detection_cond.wait_for(lambda: len(_detection_buffer) >= DETECTION_FLUSH_MAX,
+                                     timeout=DETECTION_FLUSH_INTERVAL_S)
+        flush_detections()
+
+_flusher = LazyDaemonThread(_flush_detections_loop, "detection-flusher")
+
 def save_detection(username, mode, input_text, result, url_input=None):
-    """Save detection result to database."""
+    """Queue detection result for a batched database write and return its id."""
     detection_data = {
+        "_id": ObjectId(),
         "username": username,
         "mode": mode,
         "input_text": input_text,
         "url_input": url_input,
         "result": result,
-        "timestamp": datetime.utcnow()
+        "timestamp": utc_now()
     }
-    return detections_collection.insert_one(detection_data)
+    _flusher.ensure_started()
+    with _detection_cond:
+        _detection_buffer.append(detection_data)
+        _trim_detection_buffer()
+        if len(_detection_buffer) >= DETECTION_FLUSH_MAX:
+            _detection_cond.notify()
+    return detection_data["_id"]
 
 def get_user_detections(username, limit=None):
     """Get user's detection history."""
@@ -104,29 +312,40 @@ def get_all_detections(limit=None):
         cursor = cursor.limit(limit)
     return list(cursor)
 
+def _insert_in_background(collection, document, cache_key):
+    """Insert document without blocking the caller, then drop the stale cached read."""
+    def insert():
+        try:
+            collection.insert_one(document)
+        except Exception as e:
+            print(f"Error saving to {collection.name}: {e}")
+        invalidate_cached_reads(cache_key)
+    return _write_pool.submit(insert)
+
 def save_feedback(username, detection_id, feedback_type, comments=None):
-    """Save user feedback on detection."""
+    """Queue user feedback on detection for a background write."""
     feedback_data = {
         "username": username,
         "detection_id": detection_id,
         "feedback_type": feedback_type,  # 'correct' or 'incorrect'
         "comments": comments,
-        "timestamp": datetime.utcnow()
+        "timestamp": utc_now()
     }
-    return feedback_collection.insert_one(feedback_data)
+    return _insert_in_background(feedback_collection, feedback_data, "feedback")
 
 def save_contact(name, email, subject, message):
-    """Save contact form submission."""
+    """Queue contact form submission for a background write."""
     contact_data = {
         "name": name,
         "email": email,
         "subject": subject,
         "message": message,
-        "timestamp": datetime.utcnow(),
+        "timestamp": utc_now(),
         "status": "new"
     }
-    return contacts_collection.insert_one(contact_data)
+    return _insert_in_background(contacts_collection, contact_data, "contacts")
 
+@cached_read(lambda: "contacts")
 def get_all_contacts():
     """Get all contact submissions for admin with proper serialization."""
     contacts = list(contacts_collection.find().sort("timestamp", -1))
@@ -134,6 +353,7 @@ def get_all_contacts():
         contact['_id'] = str(contact['_id'])
     return contacts
 
+@cached_read(lambda: "feedback")
 def get_all_feedback():
     """Get all feedback for admin with proper serialization."""
     feedback = list(feedback_collection.find().sort("timestamp", -1))
@@ -144,60 +364,63 @@ def get_all_feedback():
 def serialize_detection(detection):
     """Convert MongoDB detection document to JSON-serializable format"""
     if detection:
-        # Convert ObjectId to string
+        # Convert ObjectId to string; templates format the timestamp themselves
         detection['_id'] = str(detection['_id'])
-        # Ensure timestamp is properly formatted
-        if 'timestamp' in detection and hasattr(detection['timestamp'], 'isoformat'):
-            detection['timestamp_iso'] = detection['timestamp'].isoformat()
     return detection
 
 def serialize_detections(detections):
-    """Convert list of MongoDB detection documents to JSON-serializable format"""
-    return [serialize_detection(detection.copy()) for detection in detections]
+    """Convert MongoDB detection documents to JSON-serializable format in place"""
+    return [serialize_detection(detection) for detection in detections]
 
+@cached_read(_analytics_key)
 def get_analytics_data(username=None):
     """Get analytics data for user or all users with proper serialization."""
-    if username:
-        detections = list(detections_collection.find({"username": username}))
-    else:
-        detections = list(detections_collection.find())
-    
-    # Process analytics
-    total_detections = len(detections)
-    email_detections = len([d for d in detections if d["mode"] == "email"])
-    url_detections = len([d for d in detections if d["mode"] == "url"])
-    hybrid_detections = len([d for d in detections if d["mode"] == "hybrid"])
-    
-    # Count phishing vs safe
+    query = {"username": username} if username else {}
+
+    # Count by mode and verdict server-side; hybrid detections store their
+    # verdict in final_binary_pred, the other modes in binary_pred
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": {
+                "mode": "$mode",
+                "phish": {"$cond": [{"$eq": ["$mode", "hybrid"]},
+                                    "$result.final_binary_pred", "$result.binary_pred"]},
+            },
+            "n": {"$sum": 1},
+        }},
+    ]
+
+    total_detections = 0
+    mode_counts = {"email": 0, "url": 0, "hybrid": 0}
     phishing_count = 0
-    safe_count = 0
-    
-    for detection in detections:
-        result = detection.get("result", {})
-        if detection["mode"] == "hybrid":
-            if result.get("final_binary_pred") == 1:
-                phishing_count += 1
-            else:
-                safe_count += 1
-        else:
-            if result.get("binary_pred") == 1:
-                phishing_count += 1
-            else:
-                safe_count += 1
-    
-    serialized_detections = serialize_detections(detections)
+    for row in detections_collection.aggregate(pipeline):
+        n = row["n"]
+        key = row["_id"]
+        total_detections += n
+        if key.get("mode") in mode_counts:
+            mode_counts[key["mode"]] += n
+        if key.get("phish") == 1:
+            phishing_count += n
+
+    # Only the most recent detections are shipped to the templates and charts
+    recent = detections_collection.find(query).sort("timestamp", -1).limit(ANALYTICS_RECENT_LIMIT)
+    serialized_detections = serialize_detections(recent)
     
     return {
         "total_detections": total_detections,
-        "email_detections": email_detections,
-        "url_detections": url_detections,
-        "hybrid_detections": hybrid_detections,
+        "email_detections": mode_counts["email"],
+        "url_detections": mode_counts["url"],
+        "hybrid_detections": mode_counts["hybrid"],
         "phishing_count": phishing_count,
-        "safe_count": safe_count,
+        "safe_count": total_detections - phishing_count,
         "detections": serialized_detections
     }
 
-create_admin_user()
+ensure_indexes()
+ensure_admin()
+atexit.register(flush_detections)
+atexit.register(_write_pool.shutdown, wait=True)
 
 
 